@@ -1,12 +1,11 @@
 from collections import deque
 import numpy as np
 import pandas as pd
-from collections import deque
 
 
 class GeographicTree:
     '''Represents a tree structure for geographic data. Each node can have multiple children.'''
-    def __init__(self, id, constraints=None, distance_metric=None):
+    def __init__(self, id, constraints=None):
         '''Constructor of the GeographicTree class.
         
         Args:
@@ -18,10 +17,15 @@ class GeographicTree:
             children (list): A list of child nodes.
             contingency_table (np.array): The contingency table associated with this node.
 
-            constraints (list): The constraints associated with this node.
+            constraints (list): The constraints associated with this node, as tuples (constraint function, value).
 
             comparative_vector (np.array): The comparative vector associated with this node.
-            distance_metric (float): The distance metric associated with this node.
+
+            levels (list): The nodes of each level of the tree rooted at this node, computed on the first traversal.
+            level_vectors (dict): The contingency vectors of each level of the tree rooted at this node, stacked in a
+                single array per level in the order of iterate_by_levels(). The contingency vector of each node is a
+                view of its row, so they must be modified in place.
+            comparative_level_vectors (dict): The comparative vectors stacked by level in the same way.
         '''
         self.id = id
         self.geographic_values = {}
@@ -30,53 +34,43 @@ class GeographicTree:
 
         self.constraints = constraints
 
-        # NOTE: These are only used when a distance metric is defined in TopDown class.
+        # NOTE: This is only used when a distance metric is defined in TopDown class.
         self.comparative_vector = None
-        self.distance_metric = distance_metric
+
+        self.levels = None
+        self.level_vectors = None
+        self.comparative_level_vectors = None
 
     def add_child(self, child):
         '''Adds a child node to the current node.'''
         self.children.append(child)
 
-    def construct_contingency_vector(self, df: pd.DataFrame, permutation, queries: list) -> np.array:
+    def construct_contingency_vector(self, cell_index: np.array, n_cells: int, counts: np.array = None) -> np.array:
         '''Constructs the contingency vector for the permutation saved.
         
         Args:
-            df (pd.DataFrame): The dataframe to calculate the contingency vector.
-            permutation (pd.DataFrame): A dataframe that have all the possible combinations of the columns unique values.
-            queries (list): A list of queries columns.
+            cell_index (np.array): The position in the permutation of the combination of query values of each row.
+            n_cells (int): The number of possible combinations of the queries columns (rows of the permutation).
+            counts (np.array): The number of people represented by each row. Default is None (one person per row).
                
         Returns:                                                                                     
             np.array: The contingency vector.
         '''
-        # Group the data by the permutation columns and count occurrences
-        grouped = df.groupby(queries).size().reset_index(name='frequency')
-
-        # Merge to get frequencies that are not present in the given data.
-        merged = pd.merge(permutation, grouped, how='left', on=queries).fillna(0)
-
-        # Pivot vector to create the contingency vector
-        contingency_vector = pd.pivot_table(
-            merged,
-            index=queries[:-1], 
-            columns=queries[-1], 
-            values='frequency', 
-            fill_value=0, 
-            aggfunc=lambda x: x)
-        
-        # Return the contingency vector as a numpy array
-        return contingency_vector.to_numpy(dtype=int).flatten()
+        # Count the occurrences of each combination, including the ones not present in the given data.
+        # NOTE: Counts are stored as int32, the population of the whole country fits in it with plenty of room.
+        return np.bincount(cell_index, weights=counts, minlength=n_cells).astype(np.int32)
     
-    def construct_tree(self, current_level: int, df: pd.DataFrame, permutation: pd.DataFrame, geo_columns: list, queries: list, constraints_dict: dict) -> None:
+    def construct_tree(self, current_level: int, df: pd.DataFrame, cell_index: np.array, n_cells: int, geo_columns: list, constraints_dict: dict, counts: np.array = None) -> None:
         '''Constructs the geographic tree based on the provided labels and dataframe.
         
         Args:
             current_level (int): The current level of the geographic hierarchy being processed.
-            df (pd.DataFrame): The dataframe containing the data.
-            permutation (pd.DataFrame): A dataframe that have all the possible combinations of the columns unique values.
-            queries (list): A list of queries to be answered.
+            df (pd.DataFrame): The dataframe containing the data. It must be sorted by its geographic columns.
+            cell_index (np.array): The position in the permutation of the combination of query values of each row of df.
+            n_cells (int): The number of possible combinations of the queries columns (rows of the permutation).
             geo_columns (list): A list of geographic columns to be used for constructing the tree.
             constraints_dict (dict): A dictionary containing the edit constraints for each geographic column.
+            counts (np.array): The number of people represented by each row of df. Default is None (one person per row).
         '''
         last_geo_column_index = 0
         for i in geo_columns:
@@ -86,41 +80,76 @@ class GeographicTree:
         
         present_geo_columns = geo_columns[:last_geo_column_index]
 
-        if current_level < len(present_geo_columns):
-            location_ids = df[present_geo_columns[current_level]].unique()
-
-            for location_id in location_ids:
-                # Filter the dataframe for the current location ID
-                filtered_df = df[df[present_geo_columns[current_level]] == location_id]
-                
-                # Create a new child node with the filtered data
-                child_node = GeographicTree(location_id)
-                for geo_label in present_geo_columns[:current_level+1]:
-                    # Set the geographic values for the child node
-                    child_node.geographic_values[geo_label] = filtered_df[geo_label].unique()[0]
-
-                # Add edit constraints for the child node
-                if constraints_dict is not None:
-                    child_node.constraints = [(lambda array, value=filtered_df.shape[0]: constraint(array, value)) for constraint in constraints_dict[present_geo_columns[current_level]]]
-
-                # Construct the contingency vector for the child node
-                child_node.contingency_vector = self.construct_contingency_vector(filtered_df, permutation, queries)
-
-                # Recursively construct childs for the child node
-                child_node.construct_tree(current_level+1, filtered_df, permutation, geo_columns, queries, constraints_dict)
-                
-                # Add the child node to the current node
-                self.add_child(child_node)
+        if current_level < len(present_geo_columns) and df.shape[0] > 0:
+            columns = present_geo_columns[current_level:]
+
+            # Since the data is sorted, the rows of each leaf are contiguous and delimited by the changes of geographic values
+            changes = np.zeros(df.shape[0] - 1, dtype=bool)
+            for col in columns:
+                values = df[col].to_numpy()
+                changes |= values[1:] != values[:-1]
+            leaf_id = np.concatenate(([0], np.cumsum(changes)))
+            paths = list(df[columns].iloc[np.concatenate(([0], np.flatnonzero(changes) + 1))].itertuples(index=False, name=None))
+
+            # Construct the contingency vectors of all the leaves with a single count over (leaf, cell) pairs
+            leaf_vectors = np.bincount(leaf_id * n_cells + cell_index, weights=counts, minlength=len(paths) * n_cells).astype(np.int32).reshape(len(paths), n_cells)
+
+            # The vector of this node is the first level, as a single row
+            self.level_vectors = {}
+            if self.contingency_vector is not None:
+                self.level_vectors[0] = self.contingency_vector.reshape(1, -1)
+                self.contingency_vector = self.level_vectors[0][0]
+
+            # Create the nodes level by level. The leaves of a node are contiguous, so its vector is the sum of a block of leaves.
+            # NOTE: The nodes are created in the same order as the BFS, so each level keeps its single array of vectors.
+            parents = {(): self}
+            for depth in range(1, len(columns) + 1):
+                starts = [i for i in range(len(paths)) if i == 0 or paths[i][:depth] != paths[i-1][:depth]]
+                level_vectors = np.add.reduceat(leaf_vectors, starts, axis=0)
+                self.level_vectors[depth] = level_vectors
+
+                nodes = {}
+                # The population of every node of the level, used by its constraints
+                level_sizes = level_vectors.sum(axis=1).tolist()
+
+                for start, contingency_vector, n_rows in zip(starts, level_vectors, level_sizes):
+                    path = paths[start][:depth]
+                    parent = parents[path[:-1]]
+
+                    # Create a new child node with its geographic values and contingency vector
+                    child_node = GeographicTree(path[-1])
+                    child_node.geographic_values = parent.geographic_values.copy()
+                    child_node.geographic_values[columns[depth-1]] = path[-1]
+                    # The contingency vector of the child is its row of the counts
+                    child_node.contingency_vector = contingency_vector
+
+                    # Add edit constraints for the child node
+                    if constraints_dict is not None:
+                        child_node.constraints = [(constraint, n_rows) for constraint in constraints_dict[columns[depth-1]]]
+
+                    # Add the child node to its parent
+                    parent.add_child(child_node)
+                    nodes[path] = child_node
+                parents = nodes
+
+            # The levels of the tree have changed
+            self.levels = None
 
     def apply_noise(self, mechanism, rhos: list) -> None:
         '''Applies noise to all the contingency vectors of the tree with the specified mechanism.
         
-        The iteration is done in a breath-first manner, starting from the root node and going down by levels of the tree.
+        When the vectors are stacked by level, the mechanism is applied once to the whole array of each level.
+        Otherwise the iteration is done in a breath-first manner, starting from the root node and going down by levels of the tree.
 
         Args:
             mechanism (function): The noise generation function.
             rho (list): A list containing the privacy parameters for each level of the tree.
         '''
+        if self.level_vectors is not None:
+            for level, level_vectors in self.level_vectors.items():
+                mechanism(level_vectors, rhos[level])
+            return
+
         # BFS
         queue = deque([(self, 0)])   
         while queue:
@@ -140,13 +169,21 @@ class GeographicTree:
         Returns:
             int: The number of nodes in the tree.
         '''
-        count = 1
-        for child in self.children:
-            count += child.count_nodes()
-        return count
+        # NOTE: The traversal by levels is cached, so this does not walk the tree again
+        return sum(len(nodes) for _, nodes in self.iterate_by_levels())
         
     def copy_to_comparative_vector(self) -> None:
-        '''Copies the contingency vector to the comparative vector. It also calls the same method for all child nodes.'''
+        '''Copies the contingency vector to the comparative vector. It also calls the same method for all child nodes.
+        
+        When the vectors are stacked by level, each level is copied at once and the comparative vector of each node is a view of its row.
+        '''
+        if self.level_vectors is not None:
+            self.comparative_level_vectors = {level: np.copy(level_vectors) for level, level_vectors in self.level_vectors.items()}
+            for level, nodes in self.iterate_by_levels():
+                for node, comparative_vector in zip(nodes, self.comparative_level_vectors[level]):
+                    node.comparative_vector = comparative_vector
+            return
+
         if self.contingency_vector is not None:
             self.comparative_vector = np.copy(self.contingency_vector)
         
@@ -155,71 +192,76 @@ class GeographicTree:
 
     def iterate_by_levels(self):
         '''Iterates over the tree level by level and yields nodes at each level.
+
+        The traversal is done once and saved in the levels attribute, later calls reuse it.
         
         Returns:
             generator: A generator that yields tuples of (level, list of nodes at that level).
         '''
-        queue = deque([(self, 0)])  # Start with the root node and level 0
-        current_level = 0
-        level_nodes = []
+        if self.levels is None:
+            # BFS, one level at a time
+            self.levels = []
+            level_nodes = [self]
+            while level_nodes:
+                self.levels.append(level_nodes)
+                level_nodes = [child for node in level_nodes for child in node.children]
 
-        while queue:
-            node, level = queue.popleft()
+        for level, level_nodes in enumerate(self.levels):
+            yield level, level_nodes.copy()
 
-            # If we move to a new level, yield the nodes from the previous level
-            if level != current_level:
-                yield current_level, level_nodes
-                current_level = level
-                level_nodes = []
+    def level_matrix(self, nodes: list, attribute: str = 'contingency_vector') -> np.array:
+        '''Stacks a vector attribute of the given nodes into a single 2-D array.
 
-            # Add the current node to the current level
-            level_nodes.append(node)
+        Args:
+            nodes (list): The nodes to stack, usually all the nodes of a level of the tree.
+            attribute (str): The name of the vector attribute to stack. Default is 'contingency_vector'.
 
-            # Add the children of the current node to the queue
-            for child in node.children:
-                queue.append((child, level + 1))
+        Returns:
+            np.array: An array of shape (number of nodes, vector length) with one node per row.
+        '''
+        return np.stack([getattr(node, attribute) for node in nodes])
 
-        # Yield the last level
-        if level_nodes:
-            yield current_level, level_nodes
+    def as_level_matrices(self, attribute: str = 'contingency_vector') -> dict:
+        '''Stacks a vector attribute of the nodes of each level of the tree.
 
-    def compute_distance_metric(self, distance_function) -> None:
-        '''Computes the distance metric for the node and its children.
-        
         Args:
-            distance_metric (function): The distance metric function to be applied.
-        '''
-        if self.comparative_vector is not None:
-            self.distance_metric = distance_function(self.contingency_vector, self.comparative_vector)
-        
-        for child in self.children:
-            child.compute_distance_metric(distance_function)
+            attribute (str): The name of the vector attribute to stack. Default is 'contingency_vector'.
 
-    def get_distance_metric_by_level(self) -> dict:
-        '''Returns the mean distance metric for each level of the tree.
-        
         Returns:
-            dict: A dictionary where keys are levels and values are their corresponding mean of that metric values.
+            dict: A dictionary where keys are levels and values are arrays of shape (nodes at that level, vector length).
         '''
-        metric_by_level = {}
+        # The vectors may already be stacked by level
+        stacked = {'contingency_vector': self.level_vectors, 'comparative_vector': self.comparative_level_vectors}.get(attribute)
+        if stacked is not None:
+            return stacked
+        return {level: self.level_matrix(nodes, attribute) for level, nodes in self.iterate_by_levels()}
+
+    def compute_distance_metric(self, distance_function) -> dict:
+        '''Computes the mean distance metric between the contingency and comparative vectors for each level of the tree.
 
-        for level, nodes in self.iterate_by_levels():
-            metrics = [node.distance_metric for node in nodes if node.distance_metric is not None]
-            if metrics:
-                metric_by_level[level] = np.mean(metrics)
+        The vectors of all the nodes of a level are stacked so the distance is computed with a single call per level.
+        The comparative vectors must have been set with copy_to_comparative_vector().
 
-        return metric_by_level
+        Args:
+            distance_function (function): The distance metric function to be applied row-wise.
+
+        Returns:
+            dict: A dictionary where keys are levels and values are their corresponding mean of that metric values.
+        '''
+        contingency_matrices = self.as_level_matrices()
+        comparative_matrices = self.as_level_matrices('comparative_vector')
+        return {level: np.mean(distance_function(matrix, comparative_matrices[level])) for level, matrix in contingency_matrices.items()}
 
-    def extend_tree(self, raw_data: pd.DataFrame, permutation: pd.DataFrame, geo_columns: list, queries: list, constraints_dict: dict) -> tuple[list, int]:
+    def extend_tree(self, raw_data: pd.DataFrame, cell_index: np.array, n_cells: int, geo_columns: list, constraints_dict: dict, counts: np.array = None) -> tuple[list, int]:
         '''Extends the tree with the raw data and the permutation.
         
         Args:
-            raw_data (pd.DataFrame): The raw data to be used for extending the tree.
-            permutation (pd.DataFrame): A dataframe that have all the possible combinations of the columns unique values.
+            raw_data (pd.DataFrame): The raw data to be used for extending the tree. It must be sorted by its geographic columns.
+            cell_index (np.array): The position in the permutation of the combination of query values of each row of raw_data.
+            n_cells (int): The number of possible combinations of the queries columns (rows of the permutation).
             geo_columns (list): A list of geographic columns to be used for extending the tree.
-            queries_columns (list): A list of queries columns to be answered.
             constraints_dict (dict): A dictionary containing the edit constraints for each geographic column.
-
+            counts (np.array): The number of people represented by each row of raw_data. Default is None (one person per row).
 
         Returns:
             list (int, list(GeographicTree)): A list of tuples where each tuple contains the level and a list of nodes at that level.
@@ -233,29 +275,50 @@ class GeographicTree:
         if last_processed_level >= len(geo_columns):
             raise ValueError("The tree has already been fully processed. Consider incrementing the level of granularity")
         
+        # Since the data is sorted, the rows of each processed node are a contiguous block delimited by the changes of geographic values
+        processed_columns = geo_columns[:last_processed_level]
+        changes = np.zeros(max(raw_data.shape[0] - 1, 0), dtype=bool)
+        for col in processed_columns:
+            values = raw_data[col].to_numpy()
+            changes |= values[1:] != values[:-1]
+        starts = np.concatenate(([0], np.flatnonzero(changes) + 1)) if raw_data.shape[0] > 0 else np.array([], dtype=np.int64)
+        ends = np.append(starts[1:], raw_data.shape[0])
+        paths = raw_data[processed_columns].iloc[starts].itertuples(index=False, name=None)
+        blocks = dict(zip(paths, zip(starts, ends)))
+        last_processed_blocks = [blocks.get(tuple(node.geographic_values[col] for col in processed_columns), (0, 0)) for node in last_processed_nodes]
+
         # Iterate over the new geographic labels to process to create new nodes
         for label_to_process in geo_columns[last_processed_level:]:
             new_childs = []
-            for processed_node in last_processed_nodes:
-                filtered_df = raw_data
-                # Filter the raw data using the dictionary of the processed node
-                for key, value in processed_node.geographic_values.items():
-                    filtered_df = filtered_df[filtered_df[key] == value]
+            new_blocks = []
+            for processed_node, (start, end) in zip(last_processed_nodes, last_processed_blocks):
+                # Take the block of rows of the processed node
+                filtered_df = raw_data.iloc[start:end]
+                filtered_cell_index = cell_index[start:end]
+                filtered_counts = counts[start:end] if counts is not None else None
             
-                for location_id in filtered_df[label_to_process].unique():
-                    # Filter the raw data for the current location ID
-                    filtered_df = filtered_df[filtered_df[label_to_process] == location_id]
-                    
+                # Count all the children of the node with a single count over (child, cell) pairs
+                child_codes, location_ids = pd.factorize(filtered_df[label_to_process], sort=True)
+                child_vectors = np.bincount(child_codes * n_cells + filtered_cell_index, weights=filtered_counts, minlength=len(location_ids) * n_cells).astype(np.int32).reshape(len(location_ids), n_cells)
+
+                # The rows of each child are also contiguous, in the order of the location IDs
+                child_bounds = start + np.concatenate(([0], np.cumsum(np.bincount(child_codes, minlength=len(location_ids)))))
+                new_blocks.extend(zip(child_bounds[:-1], child_bounds[1:]))
+
+                # The population of every child, used by its constraints
+                child_sizes = child_vectors.sum(axis=1).tolist()
+
+                for location_id, contingency_vector, n_rows in zip(location_ids, child_vectors, child_sizes):
                     # Create a new child node with the filtered data
                     child_node = GeographicTree(location_id)
                     child_node.geographic_values = processed_node.geographic_values.copy()
                     child_node.geographic_values[label_to_process] = location_id
 
-                    # Add edit constraints for the child node       
-                    child_node.constraints = [(lambda array, value=filtered_df.shape[0]: constraint(array, value)) for constraint in constraints_dict[label_to_process]]
+                    # The contingency vector of the child is its row of the counts
+                    child_node.contingency_vector = contingency_vector
 
-                    # Construct the contingency vector for the child node
-                    child_node.contingency_vector = self.construct_contingency_vector(filtered_df, permutation, queries)
+                    # Add edit constraints for the child node       
+                    child_node.constraints = [(constraint, n_rows) for constraint in constraints_dict[label_to_process]]
 
                     # Add the child node to the current node
                     processed_node.add_child(child_node)
@@ -265,8 +328,18 @@ class GeographicTree:
 
         
             last_processed_nodes = new_childs.copy()
+            last_processed_blocks = new_blocks
             new_level += 1
+
+            # Stack the vectors of the new level and make the vector of each node a view of its row
+            if self.level_vectors is not None and new_childs:
+                self.level_vectors[new_level] = self.level_matrix(new_childs)
+                for child_node, contingency_vector in zip(new_childs, self.level_vectors[new_level]):
+                    child_node.contingency_vector = contingency_vector
             level_nodes.append((new_level, last_processed_nodes))
 
-        return level_nodes, last_processed_level
+        # The levels of the tree have changed
+        self.levels = None
+        self.comparative_level_vectors = None
 
+        return level_nodes, last_processed_level
@@ -1,5 +1,6 @@
 from top_down import TopDown
 import time
+import logging
         
 def main():
     '''Main function to run the TopDown algorithm.'''
@@ -17,6 +18,13 @@ def main():
     DATA_PATH_PERSONAS = 'data/csv-personas-censo-2017/microdato_censo2017-personas/Microdato_Censo2017-Personas.csv'
     QUERIES_PERSONAS = ['P08', 'P09'] # Sex and Age
 
+    # Dtypes used to parse the columns of the census. Every code fits in a small integer type.
+    DTYPES = {col: 'int32' for col in GEO_COLUMNS} | {col: 'int16' for col in QUERIES_PERSONAS}
+    # Rows read at a time from the census file
+    CHUNKSIZE = 1_000_000
+    # Aggregated counts of the census, reused by later runs instead of parsing the csv again
+    DATA_CACHE_PATH = DATA_PATH_PERSONAS.replace('.csv', '_counts.pkl')
+
 
     OUTPUT_PATH = 'data/out/scability/'
     OUTPUT_FILE = 'viviendas_noisy_microdata_' + PROCESS_UNTIL + '_' + '_'.join(QUERIES_PERSONAS) + '.csv'
@@ -26,30 +34,41 @@ def main():
     e_t = 10
 
     # We will consider and exponential allocation of the privacy budget across the levels of the tree.
-    aux = 0
-    for i in range(6):
-        aux += (2**i)
+    # NOTE: The weights 2**i for i in range(6) add up to 2**6 - 1.
+    aux = 2**6 - 1
 
     # Privacy parameters for the noise generation. First value for root, last for leaves.
     PRIVACY_PARAMETERS = [(e_t/aux)*(2**i) for i in range(6)]
 
     # Noise mechanism to use (discrete_laplace or discrete_gaussian).
     MECHANISM = 'discrete_laplace'
+    # Use the exact samplers of discretegauss.py (exact arithmetic and cryptographic randomness).
+    # Set to False to use the faster vectorized samplers, see the README for the trade-off.
+    EXACT_NOISE = True
 
     # Edit Constraints
     # It uses a dictionary where keys are the geographic levels and values are lists of functions that recieve
     # the contingency vector and a value. Those functions will be used to set the constraints in the optimization problem.
+    # Common constraints can be given by name instead (see NAMED_CONSTRAINTS in optimizer.py), e.g. 'sum_eq' keeps
+    # the total population of the node, like lambda contingency_vector, total_population: contingency_vector.sum() == total_population
     # TODO: Add a more complex set of constraints and implement an interface to define them.
 
     GEO_CONSTRAINTS = {
-        'REGION': [lambda contingency_vector, total_population: contingency_vector.sum() == total_population],
-        'PROVINCIA': [lambda contingency_vector, total_population: contingency_vector.sum() == total_population],
-        'COMUNA': [lambda contingency_vector, total_population: contingency_vector.sum() == total_population],
+        'REGION': ['sum_eq'],
+        'PROVINCIA': ['sum_eq'],
+        'COMUNA': ['sum_eq'],
         'DC': [],
         'ZC_LOC': []
     }
 
-    ROOT_CONSTRAINTS = [lambda contingency_vector, total_population: contingency_vector.sum() == total_population]
+    ROOT_CONSTRAINTS = ['sum_eq']
+
+    # Threads used to solve the independent estimation problems of each level in parallel.
+    # Each thread starts its own Gurobi environment, which requires a license that allows concurrent environments.
+    ESTIMATION_THREADS = 1
+    # Threads used to sample the noise of each level in parallel.
+    # Only the vectorized samplers (EXACT_NOISE = False) are sampled in parallel.
+    NOISE_THREADS = 1
 
     # Path of data that already has been processed
     # This is used to avoid reprocessing the data if it has already been processed by the algorithm.
@@ -59,11 +78,14 @@ def main():
     # Only used for testing and analysis purposes.
     DISTANCE_METRIC = None
 
-    time_start = time.time()
+    # Progress of the algorithm is reported through the logging module. Use logging.WARNING to silence it.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    time_start = time.perf_counter()
     
     topdown = TopDown()
 
-    topdown.set_mechanism(MECHANISM)
+    topdown.set_mechanism(MECHANISM, exact=EXACT_NOISE)
     topdown.set_privacy_parameters(PRIVACY_PARAMETERS)
 
     topdown.set_geo_columns(GEO_COLUMNS_TO_USE)
@@ -71,17 +93,19 @@ def main():
 
     topdown.set_geo_constraints(GEO_CONSTRAINTS)
     topdown.set_root_constraints(ROOT_CONSTRAINTS)
+    topdown.set_estimation_threads(ESTIMATION_THREADS)
+    topdown.set_noise_threads(NOISE_THREADS)
 
     topdown.set_distance_metric(DISTANCE_METRIC)
 
-    topdown.read_data(DATA_PATH_PERSONAS, sep=';')
+    topdown.read_data(DATA_PATH_PERSONAS, sep=';', dtype=DTYPES, chunksize=CHUNKSIZE, cache_path=DATA_CACHE_PATH)
     topdown.set_output_path(OUTPUT_PATH+OUTPUT_FILE)
     
     if DATA_PATH_PROCESSED: topdown.read_processed_data(DATA_PATH_PROCESSED, sep=';')
 
     # Run the TopDown algorithm
     topdown.run()
-    time_end = time.time()
+    time_end = time.perf_counter()
     print(f"TopDown algorithm finished in {time_end - time_start:.2f} seconds.\n")
     
     # This method can be used to check the correctness of the results.
@@ -0,0 +1,99 @@
+import numpy as np
+
+from discretegauss import sample_dgauss, sample_dlaplace
+
+# NOTE: The vectorized samplers draw the noise of a whole contingency vector at once with NumPy. The exact
+# mechanisms use the samplers of discretegauss.py instead, one value at a time (see the README).
+
+def sample_dlaplace_array(scale: float, size: int, rng: np.random.Generator) -> np.array:
+    '''Samples from a discrete Laplace distribution with Pr[x] proportional to exp(-abs(x)/scale).
+
+    A discrete Laplace variable is the difference of two independent geometric variables with success
+    probability 1 - exp(-1/scale).
+
+    Args:
+        scale (float): The scale of the distribution.
+        size (int or tuple): The number or shape of the samples.
+        rng (np.random.Generator): The random number generator.
+
+    Returns:
+        np.array: The samples.
+    '''
+    if scale == 0:
+        return np.zeros(size, dtype=np.int64)
+    p = -np.expm1(-1 / scale)
+    return rng.geometric(p, size) - rng.geometric(p, size)
+
+def sample_dgauss_array(sigma2: float, size: int, rng: np.random.Generator) -> np.array:
+    '''Samples from a discrete Gaussian distribution with Pr[x] proportional to exp(-x^2/(2*sigma2)).
+
+    Uses the rejection sampling from a discrete Laplace distribution of https://arxiv.org/abs/2004.00010,
+    resampling only the rejected positions on each round.
+
+    Args:
+        sigma2 (float): The variance parameter of the distribution.
+        size (int or tuple): The number or shape of the samples.
+        rng (np.random.Generator): The random number generator.
+
+    Returns:
+        np.array: The samples.
+    '''
+    samples = np.zeros(size, dtype=np.int64)
+    if sigma2 == 0:
+        return samples
+    t = np.floor(np.sqrt(sigma2)) + 1
+    flat_samples = samples.reshape(-1)
+    pending = np.arange(flat_samples.size)
+    while pending.size > 0:
+        candidates = sample_dlaplace_array(t, pending.size, rng)
+        bias = (np.abs(candidates) - sigma2 / t) ** 2 / (2 * sigma2)
+        accepted = rng.random(pending.size) < np.exp(-bias)
+        flat_samples[pending[accepted]] = candidates[accepted]
+        pending = pending[~accepted]
+    return samples
+
+def discrete_gaussian(contingency_vector: np.array, sigma2: float, rng: np.random.Generator) -> None:
+    '''Adds discrete Gaussian noise to the contingency vector in place.
+
+    Args:
+        contingency_vector (np.array): The contingency vector to be modified, or an array of stacked vectors.
+        sigma2 (float): The variance parameter of the noise, 1/(2*rho) for the privacy parameter rho.
+        rng (np.random.Generator): The random number generator.
+    '''
+    contingency_vector += sample_dgauss_array(sigma2, contingency_vector.shape, rng)
+
+def discrete_laplace(contingency_vector: np.array, scale: float, rng: np.random.Generator) -> None:
+    '''Adds discrete Laplace noise to the contingency vector in place.
+
+    Args:
+        contingency_vector (np.array): The contingency vector to be modified, or an array of stacked vectors.
+        scale (float): The scale of the noise, 1/epsilon for the privacy parameter epsilon.
+        rng (np.random.Generator): The random number generator.
+    '''
+    contingency_vector += sample_dlaplace_array(scale, contingency_vector.shape, rng)
+
+def exact_discrete_gaussian(contingency_vector: np.array, sigma2: float, rng=None) -> None:
+    '''Adds discrete Gaussian noise to the contingency vector in place with the exact sampler of discretegauss.py.
+
+    The values are drawn one at a time with the cryptographic generator of the system, so it is much slower.
+
+    Args:
+        contingency_vector (np.array): The contingency vector to be modified, or an array of stacked vectors.
+        sigma2 (float): The variance parameter of the noise, 1/(2*rho) for the privacy parameter rho.
+        rng: Ignored, the generator of the system is always used.
+    '''
+    noise = np.fromiter((sample_dgauss(sigma2) for _ in range(contingency_vector.size)), dtype=np.int64, count=contingency_vector.size)
+    contingency_vector += noise.reshape(contingency_vector.shape)
+
+def exact_discrete_laplace(contingency_vector: np.array, scale: float, rng=None) -> None:
+    '''Adds discrete Laplace noise to the contingency vector in place with the exact sampler of discretegauss.py.
+
+    The values are drawn one at a time with the cryptographic generator of the system, so it is much slower.
+
+    Args:
+        contingency_vector (np.array): The contingency vector to be modified, or an array of stacked vectors.
+        scale (float): The scale of the noise, 1/epsilon for the privacy parameter epsilon.
+        rng: Ignored, the generator of the system is always used.
+    '''
+    noise = np.fromiter((sample_dlaplace(scale) for _ in range(contingency_vector.size)), dtype=np.int64, count=contingency_vector.size)
+    contingency_vector += noise.reshape(contingency_vector.shape)
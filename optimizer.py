@@ -1,19 +1,117 @@
 import gurobipy as gp
 import numpy as np
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Constraints that can be given by name instead of a function. They work over numpy arrays and Gurobi matrix variables.
+NAMED_CONSTRAINTS = {
+    'sum_eq': lambda vector, value: vector.sum() == value,
+}
+
+def evaluate_constraint(constraint, vector, value):
+    '''Evaluates a constraint over a vector.
+
+    Args:
+        constraint (str or function): The name of a constraint in NAMED_CONSTRAINTS or a function of the vector and the value.
+        vector (np.array or gp.MVar): The vector to constrain.
+        value: The value of the constraint, e.g. the total population of the node.
+
+    Returns:
+        The result of the constraint, a boolean for numpy arrays or a Gurobi constraint for Gurobi expressions.
+    '''
+    if isinstance(constraint, str):
+        return NAMED_CONSTRAINTS[constraint](vector, value)
+    return constraint(vector, value)
+
+def satisfies_constraint(constraint, vector, value) -> bool:
+    '''Checks whether a numpy vector satisfies a constraint.
+
+    Constraints written with Gurobi helpers (e.g. gp.quicksum) give Gurobi expressions even over numpy arrays, so only
+    boolean results are trusted and any other result counts as not satisfied.
+
+    Args:
+        constraint (str or function): The name of a constraint in NAMED_CONSTRAINTS or a function of the vector and the value.
+        vector (np.array): The vector to check.
+        value: The value of the constraint, e.g. the total population of the node.
+
+    Returns:
+        bool: True if the constraint evaluates to booleans that are all True.
+    '''
+    result = evaluate_constraint(constraint, vector, value)
+    if isinstance(result, (bool, np.bool_)) or (isinstance(result, np.ndarray) and result.dtype == bool):
+        return bool(np.all(result))
+    return False
+
+@lru_cache(maxsize=None)
+def joint_positions(n_children: int, vectors_length: int) -> np.array:
+    '''Gets the positions of the cells of the children in their joint vector, shared by all the nodes with the same number of children.
+
+    Args:
+        n_children (int): The number of children.
+        vectors_length (int): The length of the contingency vectors.
+
+    Returns:
+        np.array: A read-only array where each row holds the positions of a child and each column those of a cell.
+    '''
+    positions = np.arange(n_children * vectors_length).reshape(n_children, vectors_length)
+    positions.flags.writeable = False
+    return positions
 
 class OptimizationModel:
     '''Represents an optimization model for a specific optimization problem of the geographic Tree using Gurobi.'''
 
-    def __init__(self):
+    def __init__(self, threads=None):
+        '''Constructor of the OptimizationModel class.
+
+        Args:
+            threads (int): The number of threads Gurobi may use for each model. Default is None (Gurobi default).
+
+        Attributes:
+            env (gp.Env): The Gurobi environment shared by all the models, created on the first use.
+            model (gp.Model): The last model created.
+            threads (int): The number of threads Gurobi may use for each model.
+        '''
+        self.env = None
         self.model = None
+        self.threads = threads
+
+    def new_model(self, name: str) -> gp.Model:
+        '''Creates a new model in the shared Gurobi environment.
+
+        The environment is started only once, so the license check and the parameters are not repeated for each node.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            gp.Model: The new model.
+        '''
+        if self.env is None:
+            self.env = gp.Env(empty=True)
+            self.env.setParam('OutputFlag', 0)  # Suppress Gurobi output
+            if self.threads is not None:
+                self.env.setParam('Threads', self.threads)
+            self.env.start()
+        return gp.Model(name, env=self.env)
 
     def non_negative_real_estimation(self, contingency_vector, id_node, constraints=None):
         '''Non-negative estimation of the contingency vector.
         
         This method creates a Gurobi model to estimate the contingency vector using non-negative constraints.
+        The constraints are tuples (constraint, value), where the constraint is a name of NAMED_CONSTRAINTS or a function.
         '''
-        self.model = gp.Model(f'NonNegativeRealEstimation. NodeID: {id_node}')
-        self.model.setParam('OutputFlag', 0)  # Suppress Gurobi output
+        # Without constraints the problem is separable and its solution is the projection onto the non-negative orthant
+        if not constraints:
+            return np.maximum(contingency_vector, 0.0)
+
+        # With only a constraint on the total, the solution is the projection onto a simplex
+        if len(constraints) == 1 and constraints[0][0] == 'sum_eq' and constraints[0][1] >= 0:
+            vector = np.asarray(contingency_vector, dtype=np.float64).reshape(-1, 1)
+            return self.simplex_projection(vector, np.array([constraints[0][1]]))[:, 0]
+
+        self.model = self.new_model(f'NonNegativeRealEstimation. NodeID: {id_node}')
 
         # self.model.setParam('OptimalityTol', 1e-6)  # Approximate optimality tolerance (default: 1e-6, min: 1e-9, max: 1e-2)
         # self.model.setParam('BarConvTol', 1e-6) # Tolerance for barrier convergence (default 1e-8, min: 0.0, max: 1.0)
@@ -26,18 +124,19 @@ class OptimizationModel:
         x = self.model.addMVar(shape=n, lb=0.0, name="x")
 
         # Objective function: minimize the sum of squared differences (L2 norm squared)
-        self.model.setObjective(gp.quicksum((x[i] - contingency_vector[i]) * (x[i] - contingency_vector[i]) for i in range(n)), gp.GRB.MINIMIZE)
+        difference = x - contingency_vector
+        self.model.setObjective(difference @ difference, gp.GRB.MINIMIZE)
 
         # Additional constraints
-        for i, constraint in enumerate(constraints):
-            self.model.addConstr(constraint(x), name=f"GivenConstraint_{i}")
+        for i, (constraint, value) in enumerate(constraints):
+            self.model.addConstr(evaluate_constraint(constraint, x, value), name=f"GivenConstraint_{i}")
 
         # Run the model
         self.model.optimize()
 
-        # Check for infeasibility
-        if self.model.status == gp.GRB.INFEASIBLE:
-            print(f"Model is infeasible for node {id_node}.")
+        # Check for infeasibility (the objective is bounded, so INF_OR_UNBD from presolve also means infeasible)
+        if self.model.status in (gp.GRB.INFEASIBLE, gp.GRB.INF_OR_UNBD):
+            logger.warning('Model is infeasible for node %s.', id_node)
             self.model.write("infeasible_model.lp")
             return None
 
@@ -48,35 +147,154 @@ class OptimizationModel:
         '''Rounding estimation of the contingency vector.
         
         This method creates a Gurobi model to estimate the non negative discrete contingency vector.
+        The constraints are tuples (constraint, value), where the constraint is a name of NAMED_CONSTRAINTS or a function.
         '''
-        self.model = gp.Model(f'RoundingEstimation. NodeID: {id_node}')
-        self.model.setParam('OutputFlag', 0)
-        
         n = len(x_tilde)
         
         # Rounding problem
         x_floor = np.floor(x_tilde)
         residual_round = x_tilde - x_floor
+
+        # Without constraints the problem is separable and each value is rounded to the nearest integer.
+        # NOTE: If that rounding already satisfies the constraints, it is also the optimum of the constrained problem.
+        x_nearest = x_floor + (residual_round >= 0.5)
+        if all(satisfies_constraint(constraint, x_nearest, value) for constraint, value in (constraints or [])):
+            return x_nearest
+
+        # With only a constraint on the total, the optimum rounds up the residuals closest to 1 until the total is reached
+        if len(constraints) == 1 and constraints[0][0] == 'sum_eq':
+            k = round(constraints[0][1] - x_floor.sum())
+            if 0 <= k <= n:
+                y = np.zeros(n)
+                if k > 0:
+                    y[np.argpartition(-residual_round, k - 1)[:k]] = 1
+                return x_floor + y
+
+        self.model = self.new_model(f'RoundingEstimation. NodeID: {id_node}')
         
         y = self.model.addMVar(shape=n, vtype=gp.GRB.BINARY, name="y")
 
         # Objective function: minimize the sum of squared differences (L2 norm squared)
-        self.model.setObjective(gp.quicksum((residual_round[i] - y[i]) * (residual_round[i] - y[i]) for i in range(n)), gp.GRB.MINIMIZE)
+        difference = y - residual_round
+        self.model.setObjective(difference @ difference, gp.GRB.MINIMIZE)
 
         x_rounded = x_floor + y
 
         # Additional constraints
-        for i, constraint in enumerate(constraints):
-            self.model.addConstr(constraint(x_rounded), name=f"GivenConstraint_{i}")
+        for i, (constraint, value) in enumerate(constraints):
+            self.model.addConstr(evaluate_constraint(constraint, x_rounded, value), name=f"GivenConstraint_{i}")
         
         # Run the model
         self.model.optimize()
 
-        # Check for infeasibility
-        if self.model.status == gp.GRB.INFEASIBLE:
-            print(f"Model is infeasible for node {id_node}.")
+        # Check for infeasibility (the objective is bounded, so INF_OR_UNBD from presolve also means infeasible)
+        if self.model.status in (gp.GRB.INFEASIBLE, gp.GRB.INF_OR_UNBD):
+            logger.warning('Model is infeasible for node %s.', id_node)
             self.model.write("infeasible_model.lp")
             return None
         
         return x_floor + y.X
 
+    def joint_estimation(self, parent_vector, children_vectors, children_constraints, id_node):
+        '''Estimation of the contingency vectors of the children of a node jointly, consistent with the vector of the node.
+
+        Args:
+            parent_vector (np.array): The estimated contingency vector of the node.
+            children_vectors (np.array): The noisy contingency vectors of the children, one per row.
+            children_constraints (list): The constraints of each child, as tuples (constraint, value).
+            id_node (int): The id of the node, used to name the models.
+
+        Returns:
+            np.array: The estimated contingency vectors of the children, one per row, or None if the problem is infeasible.
+        '''
+        # Without constraints on the children, the only constraints are the consistency of each cell with the node,
+        # so the problem is separable by cell and is solved in closed form
+        if not any(children_constraints):
+            x_tilde = self.simplex_projection(children_vectors, parent_vector)
+            return self.sum_rounding(x_tilde, parent_vector)
+
+        n_children, vectors_length = children_vectors.shape
+        joint_contingency_vector = children_vectors.ravel()
+        cell_positions = joint_positions(n_children, vectors_length)
+
+        # Construct the new constraints for the joint contingency vector
+        constraints = []
+        sum_rows, sum_values = [], []
+        start = 0
+        for row, child_constraints in enumerate(children_constraints):
+            end = start + vectors_length
+            for constraint, value in child_constraints:
+                if isinstance(constraint, str) and constraint == 'sum_eq':
+                    # The totals of the children are gathered in a single constraint below
+                    sum_rows.append(row)
+                    sum_values.append(value)
+                    continue
+                # NOTE: We need to use default arguments to avoid late binding issues in lambda functions.
+                constraints.append((lambda x, value, s=start, e=end, c=constraint: evaluate_constraint(c, x[s:e], value), value))
+
+            start = end
+
+        # Add the constraints on the totals of the children, for all of them at once
+        if sum_rows:
+            constraints.append((lambda joint_vector, value, rows=cell_positions[sum_rows]: joint_vector[rows].sum(axis=1) == value,
+                                np.array(sum_values)))
+        
+        # Add constraints for consistency of the values of different child nodes, for all the cells at once.
+        constraints.append((lambda joint_vector, value: joint_vector[cell_positions].sum(axis=0) == value, parent_vector))
+        
+        # Estimate the solution for the joint contingency vector
+        x_tilde = self.non_negative_real_estimation(joint_contingency_vector, id_node, constraints)
+        if x_tilde is None:
+            return None
+        joint_solution = self.rounding_estimation(x_tilde, id_node, constraints)
+        if joint_solution is None:
+            return None
+        
+        # Split the joint solution into the contingency vectors for each child node
+        return joint_solution.reshape(n_children, vectors_length)
+
+    def simplex_projection(self, vectors, totals):
+        '''Non-negative estimation of vectors whose only constraint is the sum of each position across them.
+
+        For each position i it solves min ||x[:, i] - vectors[:, i]||^2 s.t. x[:, i] >= 0 and x[:, i].sum() == totals[i],
+        that is, the Euclidean projection onto a simplex, in closed form for all the positions at once.
+        See https://arxiv.org/abs/1309.1541
+
+        Args:
+            vectors (np.array): The vectors to estimate, one per row.
+            totals (np.array): The non-negative sum of each position (column) of the solution.
+
+        Returns:
+            np.array: The estimated vectors.
+        '''
+        k = vectors.shape[0]
+        sorted_vectors = -np.sort(-vectors, axis=0)
+        cumulative = np.cumsum(sorted_vectors, axis=0) - totals
+        ranks = np.arange(1, k + 1).reshape(-1, 1)
+        # The number of positive values of the projection. It is at least 1, also for a total of 0
+        support = np.maximum(np.count_nonzero(sorted_vectors - cumulative / ranks > 0, axis=0), 1)
+        theta = np.take_along_axis(cumulative, support.reshape(1, -1) - 1, axis=0) / support
+        return np.maximum(vectors - theta, 0.0)
+
+    def sum_rounding(self, x_tilde, totals):
+        '''Rounding estimation of vectors whose only constraint is the sum of each position across them.
+
+        For each position the residuals closest to 1 are rounded up until the sum is reached, which is the optimum of
+        the rounding problem.
+
+        Args:
+            x_tilde (np.array): The non-negative estimation of the vectors, one per row. Each column must add up to its total.
+            totals (np.array): The integer sum of each position (column) of the solution.
+
+        Returns:
+            np.array: The rounded vectors.
+        '''
+        x_floor = np.floor(x_tilde)
+        residual_round = x_tilde - x_floor
+        missing = np.rint(totals - x_floor.sum(axis=0))
+
+        # Rank the residuals of each column from the largest to the smallest
+        order = np.argsort(-residual_round, axis=0, kind='stable')
+        ranks = np.empty_like(order)
+        np.put_along_axis(ranks, order, np.arange(x_tilde.shape[0]).reshape(-1, 1), axis=0)
+        return x_floor + (ranks < missing)
@@ -1,14 +1,49 @@
 import pandas as pd
-from itertools import product
 import numpy as np
+import os
 import time
-from collections import deque
+import logging
+import threading
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from geographic_tree import GeographicTree
 from optimizer import OptimizationModel
 
 from utils import manhattan_distance, euclidean_distance, tvd, cosine_similarity
-from discretegauss import sample_dgauss, sample_dlaplace
+from noise import discrete_gaussian, discrete_laplace, exact_discrete_gaussian, exact_discrete_laplace
+
+logger = logging.getLogger(__name__)
+
+# Distance metrics that can be used to compare the contingency vectors with the original ones
+DISTANCE_METRICS = {
+    'manhattan': manhattan_distance,
+    'euclidean': euclidean_distance,
+    'tvd': tvd,
+    'cosine': cosine_similarity,
+}
+
+# Number of cells of a level whose noise is drawn from the same random generator. The blocks only depend on the shape
+# of the level, so a seeded run gives the same noise with any number of noise threads.
+NOISE_BLOCK_CELLS = 2**16
+
+# Optimization model of each estimation process, created on its first task
+PROCESS_OPTIMIZER = None
+
+def estimate_children_process(task: tuple) -> np.array:
+    '''Solves the joint estimation of the children of a node in an estimation process.
+
+    Args:
+        task (tuple): The arguments of OptimizationModel.joint_estimation (see TopDown.children_estimation_task).
+
+    Returns:
+        np.array: The estimated contingency vectors of the children, one per row.
+    '''
+    global PROCESS_OPTIMIZER
+    if PROCESS_OPTIMIZER is None:
+        PROCESS_OPTIMIZER = OptimizationModel(threads=1)
+    return PROCESS_OPTIMIZER.joint_estimation(*task)
 
 class TopDown:
     '''Represents the top-down approach to implement disclosure control for a tree structured data.
@@ -19,7 +54,9 @@ class TopDown:
         '''Constructor of the TopDown class.
         
         Attributes:
-            data (pd.DataFrame): The data to be processed.
+            data (pd.DataFrame): The data to be processed, with one row per distinct record.
+            data_counts (np.array): The number of people represented by each row of the data.
+            unique_values (dict): The sorted unique values of each column of the data.
             processed_data (pd.DataFrame): The processed data to be used in the TopDown algorithm if necessary.
             geo_tree (GeographicTree): The geographic tree structure.
 
@@ -27,6 +64,8 @@ class TopDown:
 
             noise_mechanism (function): The noise generation function. (Discrete Gaussian or Laplace)
             privacy_budgets (list): The privacy parameters for each level in the tree.
+            noise_threads (int): The number of threads used to sample the noise of a level. Default is 1.
+            rng (np.random.Generator): The random number generator of the noise (PCG64DXSM).
 
             geo_columns (list): The geographic columns used to build the geographic tree.
             queries_columns (list): The query columns to be answered.
@@ -36,10 +75,15 @@ class TopDown:
             output_path (str): The path where the output file will be saved. Default is 'topdown_output.csv'.
 
             optimizer (OptimizationModel): The optimization model used for estimation.
+            estimation_threads (int): The number of threads used to solve the estimation problems of a level. Default is 1.
+            estimation_processes (int): The number of processes used to solve the estimation problems of a level. Default is 1.
+            thread_local (threading.local): The optimization model of each estimation thread.
 
-            distance_metric (str): The distance metric to be used for analysis (manhattan, euclidean, cosine, or None).
+            distance_metric (str): The distance metric to be used for analysis (a key of DISTANCE_METRICS, or None).
         '''
         self.data = None
+        self.data_counts = None
+        self.unique_values = None
         self.processed_data = None
         self.geo_tree = None
 
@@ -47,6 +91,8 @@ class TopDown:
 
         self.noise_mechanism = None
         self.privacy_budgets = None
+        self.noise_threads = 1
+        self.rng = np.random.Generator(np.random.PCG64DXSM())
 
         self.geo_columns = None
         self.queries_columns = None
@@ -56,6 +102,9 @@ class TopDown:
         self.output_path = 'topdown_output.csv'
 
         self.optimizer = OptimizationModel()
+        self.estimation_threads = 1
+        self.estimation_processes = 1
+        self.thread_local = threading.local()
 
         self.distance_metric = None
     
@@ -65,17 +114,37 @@ class TopDown:
         Args:
             columns (list): The columns to be permuted.
         '''
-        # Get unique values for each column
-        unique_values = [self.data[col].unique() for col in columns]
+        # Get the sorted unique values for each column
+        unique_values = [self.unique_values[col] for col in columns]
+
+        # Generate all possible combinations (Cartesian product).
+        # NOTE: With 'ij' indexing the combinations are already in lexicographic order of the columns.
+        grids = np.meshgrid(*unique_values, indexing='ij')
+        self.permutation = pd.DataFrame({col: grid.ravel() for col, grid in zip(columns, grids)})
 
-        # Generate all possible combinations (Cartesian product)
-        self.permutation = pd.DataFrame(
-            list(product(*unique_values)), 
-            columns=columns)
+    def encode_cells(self, df: pd.DataFrame) -> np.array:
+        '''Encodes each row of the dataframe as the position of its combination of query values in the permutation.
         
-        # Sort by the columns to ensure a consistent order
-        self.permutation.sort_values(by=columns, inplace=True)
-        self.permutation.reset_index(drop=True, inplace=True)
+        The encoding is computed once per dataframe, so the contingency vector of any subset of rows is just a count
+        of the positions of those rows.
+
+        Args:
+            df (pd.DataFrame): The dataframe to encode. It must contain the queries columns.
+        
+        Returns:
+            np.array: The position in the permutation of each row of the dataframe.
+        '''
+        # NOTE: The permutation is sorted lexicographically, so the position is the row-major index of the values.
+        cell_index = np.zeros(df.shape[0], dtype=np.int64)
+        for col in self.queries_columns:
+            categories = self.unique_values[col]
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and np.array_equal(df[col].cat.categories, categories):
+                # The columns of the loaded data are already encoded with these categories
+                codes = df[col].cat.codes.to_numpy()
+            else:
+                codes = pd.Categorical(df[col], categories=categories).codes
+            cell_index = cell_index * len(categories) + codes
+        return cell_index
 
     def init_routine(self) -> None:
         '''Initialization the routine for the TopDown class.
@@ -83,23 +152,25 @@ class TopDown:
         This method is used to set up the initial parameters for the TopDown algorithm.
         '''
 
-        print(f'Computing permutations for columns {self.queries_columns} ...')
-        time1 = time.time()
+        logger.info('Computing permutations for columns %s ...', self.queries_columns)
+        time1 = time.perf_counter()
         self.compute_permutation(self.queries_columns)
-        time2 = time.time()
-        print(f'Permutations computed with {self.permutation.shape[0]} rows and {self.permutation.shape[1]} columns in {time2-time1} seconds.\n')
+        time2 = time.perf_counter()
+        logger.info('Permutations computed with %s rows and %s columns in %s seconds.\n', self.permutation.shape[0], self.permutation.shape[1], time2-time1)
 
-        print(f'Constructing Tree...')
-        time1 = time.time()
-        self.geo_tree = GeographicTree(0, self.geo_constraints, self.distance_metric)
+        logger.info('Constructing Tree...')
+        time1 = time.perf_counter()
+        self.geo_tree = GeographicTree(0, [])
         # Initialize the contingency vector for the root node
-        self.geo_tree.contingency_vector = self.geo_tree.construct_contingency_vector(self.data, self.permutation, self.queries_columns)
-        self.geo_tree.construct_tree(0, self.data, self.permutation, self.geo_columns, self.queries_columns, self.geo_constraints)
+        cell_index = self.encode_cells(self.data)
+        self.geo_tree.contingency_vector = self.geo_tree.construct_contingency_vector(cell_index, self.permutation.shape[0], self.data_counts)
+        self.geo_tree.construct_tree(0, self.data, cell_index, self.permutation.shape[0], self.geo_columns, self.geo_constraints, self.data_counts)
         #Edit Constraint
         if self.root_constraints is not None:
-            self.geo_tree.constraints = [(lambda array, value=self.data.shape[0]: constraint(array, value)) for constraint in self.root_constraints]
-        time2 = time.time()
-        print(f'Finished constructing the tree in {time2-time1} seconds.\n')
+            n_rows = int(self.data_counts.sum())
+            self.geo_tree.constraints = [(constraint, n_rows) for constraint in self.root_constraints]
+        time2 = time.perf_counter()
+        logger.info('Finished constructing the tree in %s seconds.\n', time2-time1)
 
     def measurement_phase(self) -> None:
         '''Measurement phase of the TopDown algorithm.
@@ -108,14 +179,15 @@ class TopDown:
         It considers the privacy parameters (rhos/epsilon) defined in the configuration for each level.
         '''
         if self.distance_metric: self.geo_tree.copy_to_comparative_vector()
-        print(f'Measurement phase...')
+        logger.info('Measurement phase...')
 
-        print(f'Applying noise using {self.noise_mechanism} privacy parameters {self.privacy_budgets} ...')
-        time1 = time.time()
-        self.apply_noise(self.geo_tree, self.noise_mechanism, self.privacy_budgets)
-        time2 = time.time()
-        print(f'Noise applied in {time2-time1} seconds.\n')
-        if self.distance_metric: print(f'Distance metric {self.distance_metric} for the noisy contingency vector by levels:\n{self.compare_vectors()}\n')
+        logger.info('Applying noise using %s privacy parameters %s ...', self.noise_mechanism, self.privacy_budgets)
+        time1 = time.perf_counter()
+        with self.noise_executor() as executor:
+            self.apply_noise(self.geo_tree, self.noise_mechanism, self.noise_scales(self.privacy_budgets), executor)
+        time2 = time.perf_counter()
+        logger.info('Noise applied in %s seconds.\n', time2-time1)
+        if self.distance_metric and logger.isEnabledFor(logging.INFO): logger.info('Distance metric %s for the noisy contingency vector by levels:\n%s\n', self.distance_metric, self.compare_vectors())
 
     def estimation_phase(self) -> None:
         '''Estimation phase of the TopDown algorithm.
@@ -126,78 +198,132 @@ class TopDown:
             2. Non-negative discrete estimation of the previous result. (Rounding problem)
         '''
         if self.distance_metric: self.geo_tree.copy_to_comparative_vector()
-        print(f'Estimation phase...')
-        print(f'Running estimation for root node...')
-        time1 = time.time()
+        logger.info('Estimation phase...')
+        logger.info('Running estimation for root node...')
+        time1 = time.perf_counter()
         self.root_estimation()
-        time2 = time.time()
-        print(f'Finished estimating the solution for root node in {time2-time1} seconds.\n')
+        time2 = time.perf_counter()
+        logger.info('Finished estimating the solution for root node in %s seconds.\n', time2-time1)
 
-        print(f'Running estimation for children nodes recursively...')
-        time1 = time.time()
-        self.recursive_estimation(self.geo_tree)
-        time2 = time.time()
-        print(f'Finished estimating the solution for children nodes in {time2-time1} seconds.\n')
-        if self.distance_metric: print(f'Distance metric {self.distance_metric} for the estimation phase by levels:\n{self.compare_vectors()}\n')
+        logger.info('Running estimation for children nodes recursively...')
+        time1 = time.perf_counter()
+        with self.estimation_executor() as executor:
+            self.recursive_estimation(self.geo_tree, executor)
+        time2 = time.perf_counter()
+        logger.info('Finished estimating the solution for children nodes in %s seconds.\n', time2-time1)
+        if self.distance_metric and logger.isEnabledFor(logging.INFO): logger.info('Distance metric %s for the estimation phase by levels:\n%s\n', self.distance_metric, self.compare_vectors())
 
     def root_estimation(self) -> None:
         '''Estimates the contingency vector for the root node of the geographic tree.'''
 
         x_tilde = self.optimizer.non_negative_real_estimation(self.geo_tree.contingency_vector, self.geo_tree.id, self.geo_tree.constraints)
-        self.geo_tree.contingency_vector = self.optimizer.rounding_estimation(x_tilde, self.geo_tree.id, self.geo_tree.constraints)    
+        solution = None if x_tilde is None else self.optimizer.rounding_estimation(x_tilde, self.geo_tree.id, self.geo_tree.constraints)
+        if solution is None:
+            raise RuntimeError(f'The estimation of the root node {self.geo_tree.id} is infeasible, see infeasible_model.lp.')
+        # NOTE: The vector is a view of the level vectors of the tree, so the solution is written in place
+        self.geo_tree.contingency_vector[:] = np.rint(solution)
 
-    def recursive_estimation(self, node: GeographicTree) -> None:
-        '''Recursively estimates the contingency vector for the children nodes of the geographic tree.'''
-        
+    def estimation_executor(self):
+        '''Creates the executor used to solve the estimation problems of each level in parallel.
+
+        It is created once per estimation phase, so its workers and their optimization models are reused by all the levels,
+        and it must be used as a context manager so the workers are shut down even if the estimation fails.
+        Processes take precedence over threads when both are set.
+
+        Returns:
+            Executor: A ProcessPoolExecutor or a ThreadPoolExecutor, or a null context giving None when a single estimation
+                process and thread are set.
+        '''
+        if self.estimation_processes > 1:
+            # NOTE: Spawned processes do not inherit the Gurobi environment or the threads of this process
+            return ProcessPoolExecutor(max_workers=self.estimation_processes, mp_context=multiprocessing.get_context('spawn'))
+        if self.estimation_threads > 1:
+            return ThreadPoolExecutor(max_workers=self.estimation_threads)
+        return nullcontext()
+
+    def recursive_estimation(self, node: GeographicTree, executor=None) -> None:
+        '''Estimates the contingency vectors of all the descendants of a node, going down level by level.
+
+        The children of the different nodes of a level are independent problems, so they are solved in parallel
+        when more than one estimation process or thread is set. Processes also run the Python side of the models in
+        parallel, but the constraints must be picklable (named constraints or module-level functions).
+
+        Args:
+            node (GeographicTree): The node whose descendants are estimated.
+            executor (Executor): The executor of the estimation processes or threads (see estimation_executor). Default is
+                None (solve the problems serially).
+        '''
         level = len(node.geographic_values.keys())
-        queue = deque([(node, level)])
-        time1 = time.time()
-        if self.processed_data is None: print(f'Running estimation for {self.geo_columns[level]}...', end=' ')
-        while queue:
-            node, current_level = queue.popleft()
-            if self.processed_data is None and level != current_level:
-                print(round(time.time() - time1, 4), 'seconds.')
-                level = current_level
-                if current_level < len(self.geo_columns):
-                    print(f'Running estimation for {self.geo_columns[current_level]}...', end=' ')
-                    time1 = time.time()
-
-            if not node.children: continue # Skip nodes without children
-            
-            childs_contingency_vectors = [child.contingency_vector for child in node.children]
-            joint_contingency_vector = np.concatenate(childs_contingency_vectors)
-
-            # Construct the new constraints for the joint contingency vector
-            constraints = []
-            vectors_length = self.permutation.shape[0]
-            start = 0
-            for child in node.children:
-                end = start + vectors_length
-                for constraint in child.constraints:
-                    # NOTE: We need to use default arguments to avoid late binding issues in lambda functions.
-                    constraints.append(lambda x, s=start, e=end, c=constraint: c(x[s:e]))
-
-                start = end
-            
-            # Add constraints for consistency of the values of different child nodes
-            for index in range(vectors_length):
-                constraints.append(lambda joint_vector, s=index, value=node.contingency_vector[index]: 
-                                joint_vector[s::vectors_length].sum() == value)
-            
-            # Estimate the solution for the joint contingency vector
-            x_tilde = self.optimizer.non_negative_real_estimation(joint_contingency_vector, node.id, constraints)
-            joint_solution = self.optimizer.rounding_estimation(x_tilde, node.id, constraints)
-            
-            # Split the joint solution into the contingency vectors for each child node
-            start = 0
-            for child in node.children:
-                end = start + vectors_length
-                child.contingency_vector = joint_solution[start:end]
-                start = end
-
-            # Add each child node to the queue for further processing
-            for child in node.children:
-                queue.append((child, current_level + 1))
+        nodes = [node]
+        while True:
+            parents = [node for node in nodes if node.children] # Skip nodes without children
+            if not parents: break
+
+            time1 = time.perf_counter()
+            if isinstance(executor, ProcessPoolExecutor) and len(parents) > 1:
+                tasks = [self.children_estimation_task(parent) for parent in parents]
+                chunksize = max(1, len(tasks) // (4 * self.estimation_processes))
+                for parent, solution in zip(parents, executor.map(estimate_children_process, tasks, chunksize=chunksize)):
+                    self.set_children_solution(parent, solution)
+            elif executor is not None and len(parents) > 1:
+                list(executor.map(self.estimate_children, parents))
+            else:
+                for parent in parents:
+                    self.estimate_children(parent)
+            if self.processed_data is None: logger.info('Running estimation for %s... %.4f seconds.', self.geo_columns[level], time.perf_counter() - time1)
+
+            nodes = [child for parent in parents for child in parent.children]
+            level += 1
+
+    def estimate_children(self, node: GeographicTree) -> None:
+        '''Estimates the contingency vectors of the children of a node jointly, consistent with the vector of the node.
+
+        Args:
+            node (GeographicTree): The node whose children are estimated. Its contingency vector must be already estimated.
+        '''
+        solution = self.get_optimizer().joint_estimation(*self.children_estimation_task(node))
+        self.set_children_solution(node, solution)
+
+    def children_estimation_task(self, node: GeographicTree) -> tuple:
+        '''Gets the arguments of the joint estimation of the children of a node.
+
+        Args:
+            node (GeographicTree): The node whose children are estimated.
+
+        Returns:
+            tuple: The vector of the node, the stacked vectors of the children, their constraints and the id of the node.
+        '''
+        childs_contingency_vectors = np.stack([child.contingency_vector for child in node.children])
+        return node.contingency_vector, childs_contingency_vectors, [child.constraints for child in node.children], node.id
+
+    def set_children_solution(self, node: GeographicTree, solution: np.array) -> None:
+        '''Writes the estimated contingency vectors of the children of a node.
+
+        Args:
+            node (GeographicTree): The node whose children were estimated.
+            solution (np.array): The estimated contingency vectors of the children, one per row, or None if the problem
+                is infeasible.
+        '''
+        if solution is None:
+            raise RuntimeError(f'The estimation of the children of node {node.id} is infeasible, see infeasible_model.lp.')
+        # NOTE: The vectors are views of the level vectors of the tree, so the solution is written in place
+        for child, contingency_vector in zip(node.children, solution):
+            child.contingency_vector[:] = np.rint(contingency_vector)
+
+    def get_optimizer(self) -> OptimizationModel:
+        '''Gets the optimization model of the current thread.
+
+        Each estimation thread has its own model with a single Gurobi thread, so the threads do not share state or
+        oversubscribe the cores.
+
+        Returns:
+            OptimizationModel: The optimization model to use in the current thread.
+        '''
+        if threading.current_thread() is threading.main_thread():
+            return self.optimizer
+        if not hasattr(self.thread_local, 'optimizer'):
+            self.thread_local.optimizer = OptimizationModel(threads=1)
+        return self.thread_local.optimizer
 
     def construct_microdata(self) -> pd.DataFrame:
         '''Constructs the microdata from the contingency vector of the geographic tree.
@@ -205,137 +331,176 @@ class TopDown:
         Returns:
             pd.DataFrame: The constructed microdata.
         '''
-        print(f'Constructing microdata from the contingency vector...')
-        time1 = time.time()
-        # Recursively construct the microdata from the contingency vector of the geographic tree
-        microdata_dict = self.recursive_construct_microdata(self.geo_tree, 0)
-        time2 = time.time()
-        print(f'Finished constructing microdata in {time2-time1} seconds.\n')
-
-        print(f'Writing microdata to {self.output_path} ...')
-        time1 = time.time()
+        logger.info('Constructing microdata from the contingency vector...')
+        time1 = time.perf_counter()
+        # Construct the microdata from the contingency vectors of the leaves of the geographic tree
+        microdata_dict = self.leaves_microdata(self.geo_tree)
+        time2 = time.perf_counter()
+        logger.info('Finished constructing microdata in %s seconds.\n', time2-time1)
+
+        logger.info('Writing microdata to %s ...', self.output_path)
+        time1 = time.perf_counter()
         # Convert the dictionary to a DataFrame and return
-        noisy_df = pd.DataFrame(microdata_dict)
+        # NOTE: The DataFrame wraps the arrays of the columns without copying them, so the microdata is held in memory
+        # only once. to_csv already formats and writes the rows in chunks.
+        noisy_df = pd.DataFrame(microdata_dict, copy=False)
+        del microdata_dict
         noisy_df.to_csv(self.output_path, index=False, sep=';')
-        time2 = time.time()
-        print(f'Finished writing microdata in {time2-time1} seconds.\n')
-        print(f'Process finished :)\n')
+        time2 = time.perf_counter()
+        logger.info('Finished writing microdata in %s seconds.\n', time2-time1)
+        logger.info('Process finished :)\n')
         return noisy_df
 
-    def recursive_construct_microdata(self, node: GeographicTree, current_tree_level: int) -> pd.DataFrame:
-        '''Recursively calls to construct a microdata of all leaves of the tree.
-        
+    def leaves_microdata(self, node: GeographicTree) -> dict:
+        '''Constructs the microdata of all the leaves below a node of the tree.
+
+        The leaves are collected in preorder with an explicit stack, and each column is built for all of them at once,
+        repeating each combination of the permutation as many times as its count in the contingency vector of each leaf.
+
         Args:
-            node (GeographicTree): The current node of the tree.
-            geo_info_list (list): The list of geographic information to be added to the microdata.
+            node (GeographicTree): The node of the tree.
         Returns:
-            pd.DataFrame: The constructed microdata.
+            dict: The constructed microdata, an array for each column.
         '''
-        microdata_dict = None
-        # Base case: if the node is a leaf, construct the microdata for that node
-        if not node.children:
-            # Create a Diccionary to store the microdata for the current node
-            microdata_dict = {col: [] for col in self.geo_columns+self.queries_columns}
-            current_index = 0
-            for index, row in self.permutation.iterrows():
-                for col in self.queries_columns:
-                    # Add the value of the row[col] node.contingency_vector[index] times to the dictionary
-                    microdata_dict[col].extend(np.repeat(row[col], node.contingency_vector[index]))
-            current_index += 1
-            # Add the geographic information for the current node
-            for key, val in node.geographic_values.items():
-                microdata_dict[key] = list(np.repeat(val, len(microdata_dict[self.queries_columns[0]])))
-        # Recursive case: if the node has children
-        else:
-            microdata_dict = {}
-            for child in node.children:
-                # Recursively call the function for each child node
-                child_microdata = self.recursive_construct_microdata(child, current_tree_level + 1)
-                # Concatenate the microdata from the child node to the current microdata
-                for key in child_microdata.keys():
-                    if key in microdata_dict:
-                        microdata_dict[key].extend(child_microdata[key])
-                    else:
-                        microdata_dict[key] = child_microdata[key]
-                                
+        leaves = []
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.children:
+                # Reversed so the children are visited in order
+                stack.extend(reversed(current.children))
+            else:
+                leaves.append(current)
+
+        counts = np.stack([leaf.contingency_vector for leaf in leaves]).astype(np.int64)
+        leaf_sizes = counts.sum(axis=1)
+
+        microdata_dict = {}
+        # Add the geographic information of each leaf
+        for col in self.geo_columns:
+            if col in leaves[0].geographic_values:
+                microdata_dict[col] = np.repeat(np.array([leaf.geographic_values[col] for leaf in leaves]), leaf_sizes)
+        # The contingency vectors of the leaves are consecutive, so the permutation is tiled once per leaf
+        counts = counts.ravel()
+        for col in self.queries_columns:
+            microdata_dict[col] = np.repeat(np.tile(self.permutation[col].to_numpy(), len(leaves)), counts)
         return microdata_dict
     
-    def set_mechanism(self, mechanism: str) -> None:
+    def set_mechanism(self, mechanism: str, exact=True) -> None:
         '''Sets the noise generation mechanism.
         
         Args:
             mechanism (str): The noise generation mechanism to be used.
+            exact (bool): Whether to use the exact samplers of discretegauss.py with the cryptographic generator of the
+                system. If False, the faster vectorized samplers of noise.py are used. Default is True.
         '''
         if mechanism == 'discrete_gaussian':
-            self.noise_mechanism = self.discrete_gaussian
+            self.noise_mechanism = exact_discrete_gaussian if exact else discrete_gaussian
         elif mechanism == 'discrete_laplace':
-            self.noise_mechanism = self.discrete_laplace
+            self.noise_mechanism = exact_discrete_laplace if exact else discrete_laplace
+
+    def noise_scales(self, privacy_parameters: list) -> list:
+        '''Computes the parameter of the noise distribution of each level from its privacy parameter.
+
+        It is done once per level, so the mechanisms receive the parameter of the distribution directly.
 
-    def apply_noise(self, node: GeographicTree, mechanism, privacy_parameters: list) -> None:
+        Args:
+            privacy_parameters (list): The privacy parameters for each level (rho for discrete Gaussian, epsilon for discrete Laplace).
+
+        Returns:
+            list: The variance parameter (discrete Gaussian) or the scale (discrete Laplace) of the noise for each level.
+        '''
+        privacy_parameters = np.asarray(privacy_parameters, dtype=np.float64)
+        if self.noise_mechanism in (discrete_gaussian, exact_discrete_gaussian):
+            # rho-zCDP for counts with sensitivity 1 needs sigma^2 = 1/(2*rho)
+            return (1 / (2 * privacy_parameters)).tolist()
+        # TODO: Refactor to generalize the sensitivity
+        return (1 / privacy_parameters).tolist()
+
+    def noise_executor(self):
+        '''Creates the executor used to sample the noise of the blocks of each level in parallel.
+
+        It is created once per measurement phase and must be used as a context manager. The exact samplers run in Python
+        while holding the GIL, so they are never sampled in parallel.
+
+        Returns:
+            ThreadPoolExecutor: The executor, or a null context giving None when a single noise thread is set or the
+                mechanism is exact.
+        '''
+        if self.noise_threads > 1 and self.noise_mechanism not in (exact_discrete_gaussian, exact_discrete_laplace):
+            return ThreadPoolExecutor(max_workers=self.noise_threads)
+        return nullcontext()
+
+    def apply_noise(self, node: GeographicTree, mechanism, privacy_parameters: list, executor=None) -> None:
         '''Applies noise to the tree contingency vectors using the specified mechanism.
         
         Args:
             mechanism (function): The noise generation function.
-            privacy_parameters (list): The privacy parameters for each level.
+            privacy_parameters (list): The parameters of the noise distribution for each level (see noise_scales).
+            executor (ThreadPoolExecutor): The executor of the noise threads (see noise_executor). Default is None.
         '''
         if node is not None:
-            node.apply_noise(mechanism, privacy_parameters)
+            if mechanism in (exact_discrete_gaussian, exact_discrete_laplace):
+                # The exact samplers use the generator of the system, so there is nothing to split between generators
+                node.apply_noise(mechanism, privacy_parameters)
+            else:
+                node.apply_noise(lambda vectors, parameter: self.block_noise(mechanism, vectors, parameter, executor), privacy_parameters)
+
+    def block_noise(self, mechanism, contingency_vectors: np.array, privacy_parameter: float, executor=None) -> None:
+        '''Applies the mechanism to blocks of rows of an array of stacked vectors, in parallel if an executor is given.
+
+        Each block of about NOISE_BLOCK_CELLS cells draws its noise from its own generator spawned from the generator
+        of the instance. The blocks do not depend on the number of threads, so neither does the noise of a seeded run.
+
+        Args:
+            mechanism (function): The noise generation function.
+            contingency_vectors (np.array): The contingency vector to be modified, or an array of stacked vectors.
+            privacy_parameter (float): The parameter of the noise distribution of the level.
+            executor (ThreadPoolExecutor): The executor of the noise threads (see noise_executor). Default is None.
+        '''
+        if contingency_vectors.ndim < 2:
+            mechanism(contingency_vectors, privacy_parameter, self.rng)
+            return
+
+        # NOTE: The blocks are views of the rows, so the noise is added in place to the vectors of the tree
+        rows = max(1, NOISE_BLOCK_CELLS // max(1, contingency_vectors.shape[1]))
+        blocks = [contingency_vectors[start:start+rows] for start in range(0, len(contingency_vectors), rows)]
+        rngs = self.rng.spawn(len(blocks))
+        if executor is not None and len(blocks) > 1:
+            list(executor.map(lambda block, rng: mechanism(block, privacy_parameter, rng), blocks, rngs))
+        else:
+            for block, rng in zip(blocks, rngs):
+                mechanism(block, privacy_parameter, rng)
 
     def check_correctness(self) -> None:
         '''Checks the correctness of the tree structure considering that its childs sums up to the parent node.
         '''
         if self.geo_tree is not None:
-            print(f'Checking correctness of the tree...')
-            time1 = time.time()
+            logger.info('Checking correctness of the tree...')
+            time1 = time.perf_counter()
             self.check_correctness_node(self.geo_tree)
-            time2 = time.time()
-            print(f'Finished checking correctness in {time2-time1} seconds.\n')
+            time2 = time.perf_counter()
+            logger.info('Finished checking correctness in %s seconds.\n', time2-time1)
 
 
     def check_correctness_node(self, node) -> None:
-        '''Checks that the sum of the values of the current node are equal to the sum of the values of its children.
-        '''
-        if node.children:
-            # Check if the sum of the contingency vectors of the children nodes is equal to the parent node's contingency vector
-            node_sum = np.sum(node.contingency_vector)
-            children_sum = 0
-            for child in node.children:
-                children_sum += np.sum(child.contingency_vector)
-
-            if node_sum != children_sum:            
-                print(f'Error: The sum of the contingency vectors of the children nodes is not equal to the parent node\'s contingency vector.')
-                print(f'Parent node contingency vector: {node.contingency_vector}')
-                return
-            else:
-                for child in node.children:
-                    self.check_correctness_node(child)
+        '''Checks that the values of each node below the given one are equal to the sum of the values of its children.
 
-    def discrete_gaussian(self, contingency_vector: np.array, rho: float) -> None:
-        '''Applies discrete Gaussian noise to the contingency vector.
-        
-        Args:
-            contingency_vector (np.array): The contingency vector to be modified.
-            rho (float): The privacy parameter.
-        
-        Returns:
-            np.array: The modified contingency vector with added noise.
-        '''
-        for i in range(len(contingency_vector)):
-            contingency_vector[i] += sample_dgauss(rho)
-    
-    def discrete_laplace(self, contingency_vector: np.array, epsilon: float) -> None:
-        '''Applies Laplace noise to the contingency vector.
-        
-        Args:
-            contingency_vector (np.array): The contingency vector to be modified.
-            rho (float): The privacy parameter.
-        
-        Returns:
-            np.array: The modified contingency vector with added noise.
+        The subtree is traversed with an explicit stack, and each cell of the contingency vector is checked, which also
+        implies that the totals match. The subtree of a node that fails the check is not traversed.
         '''
-        # TODO: Refactor to generalize the sensitivity
-        for i in range(len(contingency_vector)):
-            contingency_vector[i] += sample_dlaplace(1/epsilon)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not node.children:
+                continue
+            # Check if the sum of the contingency vectors of the children nodes is equal to the parent node's contingency vector
+            children_sum = np.stack([child.contingency_vector for child in node.children]).sum(axis=0)
+            if not np.array_equal(node.contingency_vector, children_sum):
+                logger.error('The sum of the contingency vectors of the children nodes is not equal to the parent node\'s contingency vector.')
+                logger.error('Parent node contingency vector: %s', node.contingency_vector)
+                continue
+            stack.extend(node.children)
 
     def compare_vectors(self) -> dict:
         '''Compares the contingency vector with the comparative vector at each level of the tree. 
@@ -344,19 +509,7 @@ class TopDown:
         Returns:
             dict: A dictionary with the distance metric for each level of the tree.
         '''
-        match self.distance_metric:
-            case 'manhattan':
-                distance_function = manhattan_distance
-            case 'euclidean':
-                distance_function = euclidean_distance
-            case 'tvd':
-                distance_function = tvd
-            case 'cosine':
-                distance_function = cosine_similarity
-            case _:
-                raise ValueError(f'Unknown distance metric: {self.distance_metric}, choose from manhattan, euclidean, tvd or None.')
-        self.geo_tree.compute_distance_metric(distance_function)
-        return self.geo_tree.get_distance_metric_by_level()
+        return self.geo_tree.compute_distance_metric(DISTANCE_METRICS[self.distance_metric])
     
     def run(self) -> pd.DataFrame:
         '''Runs the TopDown alogorithm
@@ -365,10 +518,10 @@ class TopDown:
             pd.DataFrame: The final dataframe with the DP-data.
         '''
         if self.processed_data is not None:
-            print(f'Running TopDown algorithm with processed data...\n')
+            logger.info('Running TopDown algorithm with processed data...\n')
             return self.resume_run()
         else:
-            print(f'Running TopDown alogorithm from scratch...\n')
+            logger.info('Running TopDown alogorithm from scratch...\n')
             self.init_routine()
             self.measurement_phase()
             self.estimation_phase()
@@ -378,8 +531,9 @@ class TopDown:
         '''Loads the state of a previous run of the TopDown algorithm from a file.'''
         self.compute_permutation(self.queries_columns)
         self.geo_tree = GeographicTree(0)
-        self.geo_tree.contingency_vector = self.geo_tree.construct_contingency_vector(self.processed_data, self.permutation, self.queries_columns)
-        self.geo_tree.construct_tree(0, self.processed_data, self.permutation, self.geo_columns, self.queries_columns, self.geo_constraints)
+        cell_index = self.encode_cells(self.processed_data)
+        self.geo_tree.contingency_vector = self.geo_tree.construct_contingency_vector(cell_index, self.permutation.shape[0])
+        self.geo_tree.construct_tree(0, self.processed_data, cell_index, self.permutation.shape[0], self.geo_columns, self.geo_constraints)
 
     def extend_tree(self) -> tuple[list, int]:
         '''Extends the tree to include the new data.
@@ -388,8 +542,9 @@ class TopDown:
             list (int, list(GeographicTree)): A list of tuples where each tuple contains the level and a list of nodes at that level.
             int: The level of the last level processed in a previous run of the algorithm.
         '''
-        level_nodes, last_processed_level = self.geo_tree.extend_tree(self.data, self.permutation, self.geo_columns, self.queries_columns, self.geo_constraints)
+        level_nodes, last_processed_level = self.geo_tree.extend_tree(self.data, self.encode_cells(self.data), self.permutation.shape[0], self.geo_columns, self.geo_constraints, self.data_counts)
         self.data = None
+        self.data_counts = None
         return level_nodes, last_processed_level
 
     def resume_measurement_phase(self, level_nodes, last_processed_level) -> None:
@@ -402,10 +557,11 @@ class TopDown:
             last_processed_level (int): The level of the last level processed in a previous run of the algorithm.
         '''
         _, nodes_to_noisify = level_nodes[last_processed_level+1]
-        privacy_parameters_to_use = self.privacy_budgets[last_processed_level+1:]
+        privacy_parameters_to_use = self.noise_scales(self.privacy_budgets[last_processed_level+1:])
 
-        for node in nodes_to_noisify:
-            self.apply_noise(node, self.noise_mechanism, privacy_parameters_to_use)
+        with self.noise_executor() as executor:
+            for node in nodes_to_noisify:
+                self.apply_noise(node, self.noise_mechanism, privacy_parameters_to_use, executor)
 
     def resume_estimation_phase(self, level_nodes, last_processed_level) -> None:
         '''Resumes the estimation phase of the TopDown algorithm from a previous state.
@@ -417,8 +573,9 @@ class TopDown:
             last_processed_level (int): The level of the last level processed in a previous run of the algorithm.
         '''
         _, nodes_to_estimate = level_nodes[last_processed_level]
-        for node in nodes_to_estimate:
-            self.recursive_estimation(node)
+        with self.estimation_executor() as executor:
+            for node in nodes_to_estimate:
+                self.recursive_estimation(node, executor)
 
     def resume_run(self) -> pd.DataFrame:
         '''Resumes the run of the TopDown algorithm from a previous state.
@@ -426,26 +583,26 @@ class TopDown:
         Returns:
             pd.DataFrame: The final dataframe with the DP-data.
         '''
-        time1 = time.time()
-        print(f'Recovering state from previous run considering processed data...')
+        time1 = time.perf_counter()
+        logger.info('Recovering state from previous run considering processed data...')
         self.load_state()
-        print(f'Finished recovering state in {time.time()-time1} seconds.\n')
+        logger.info('Finished recovering state in %s seconds.\n', time.perf_counter()-time1)
 
-        time1 = time.time()
-        print(f'Extending the tree with new data until reaching {self.geo_columns[-1]} granularity...')
+        time1 = time.perf_counter()
+        logger.info('Extending the tree with new data until reaching %s granularity...', self.geo_columns[-1])
         level_nodes, last_processed_level = self.extend_tree()
-        print(f'Finished extending the tree in {time.time()-time1} seconds.\n')
+        logger.info('Finished extending the tree in %s seconds.\n', time.perf_counter()-time1)
 
-        time1 = time.time()
-        print(f'Running measurement phase for the new data...')
+        time1 = time.perf_counter()
+        logger.info('Running measurement phase for the new data...')
         self.resume_measurement_phase(level_nodes, last_processed_level)
-        print(f'Finished measurement phase in {time.time()-time1} seconds.\n')
+        logger.info('Finished measurement phase in %s seconds.\n', time.perf_counter()-time1)
 
-        time1 = time.time()
-        print(f'Running estimation phase for the new data...')
-        print(f'Starting at level of {self.geo_columns[last_processed_level]}...')
+        time1 = time.perf_counter()
+        logger.info('Running estimation phase for the new data...')
+        logger.info('Starting at level of %s...', self.geo_columns[last_processed_level])
         self.resume_estimation_phase(level_nodes, last_processed_level)
-        print(f'Finished estimation phase in {time.time()-time1} seconds.\n')
+        logger.info('Finished estimation phase in %s seconds.\n', time.perf_counter()-time1)
         
         return self.construct_microdata()
 
@@ -474,6 +631,46 @@ class TopDown:
         '''
         self.queries_columns = queries
 
+    def set_estimation_threads(self, estimation_threads: int) -> None:
+        '''Sets the number of threads used to solve the estimation problems of each level in parallel.
+        
+        Args:
+            estimation_threads (int): The number of threads to be used.
+        '''
+        self.estimation_threads = estimation_threads
+
+    def set_estimation_processes(self, estimation_processes: int) -> None:
+        '''Sets the number of processes used to solve the estimation problems of each level in parallel.
+        
+        The constraints of the nodes must be picklable, i.e. named constraints or module-level functions.
+
+        Args:
+            estimation_processes (int): The number of processes to be used.
+        '''
+        self.estimation_processes = estimation_processes
+
+    def set_noise_threads(self, noise_threads: int) -> None:
+        '''Sets the number of threads used to sample the noise of each level in parallel.
+
+        Only the vectorized samplers (set_mechanism with exact=False) are sampled in parallel, and only on levels with more
+        than one block of NOISE_BLOCK_CELLS cells.
+        
+        Args:
+            noise_threads (int): The number of threads to be used.
+        '''
+        self.noise_threads = noise_threads
+
+    def set_seed(self, seed: int) -> None:
+        '''Sets the seed of the random number generator of the noise, to make the noise reproducible.
+
+        Only the vectorized samplers (set_mechanism with exact=False) use this generator. The noise does not depend on the
+        number of noise threads, so a seeded run is reproducible on machines with a different number of cores.
+        
+        Args:
+            seed (int): The seed to be used.
+        '''
+        self.rng = np.random.Generator(np.random.PCG64DXSM(np.random.SeedSequence(seed)))
+
     def set_geo_constraints(self, geo_constraints: dict) -> None:
         '''Sets the geographic constraints for the TopDown algorithm.
         
@@ -494,28 +691,64 @@ class TopDown:
         '''Sets the distance metric for the TopDown algorithm.
         
         Args:
-            distance_metric (str): The distance metric to be used (manhattan, euclidean, cosine, or None).
+            distance_metric (str): The distance metric to be used (a key of DISTANCE_METRICS, or None).
         '''
+        if distance_metric is not None and distance_metric not in DISTANCE_METRICS:
+            raise ValueError(f'Unknown distance metric: {distance_metric}, choose from {", ".join(DISTANCE_METRICS)} or None.')
         self.distance_metric = distance_metric
 
-    def read_data(self, data_path: str, sep=',') -> None:
+    def read_data(self, data_path: str, sep=',', dtype=None, chunksize=None, cache_path=None) -> None:
         '''Sets the data for the TopDown algorithm.
+
+        The file is aggregated to the count of each distinct record, which is all the algorithm needs to build the
+        contingency vectors.
         
         Args:
             data_path (str): The path to the data file in csv to be processed.
             sep (str): The separator used in the csv file. Default is ','.
+            dtype (dict): Optional mapping of columns to the dtypes used to parse them, e.g. small integer types for
+                the codes of the census. It avoids the type inference and the 64-bit buffers of the parser. Default is None.
+            chunksize (int): Optional number of rows to read at a time. Each chunk is aggregated before reading the
+                next one, so the whole file is never held in memory. Default is None (read the file at once).
+            cache_path (str): Optional path of a pickle file with the aggregated counts and the parameters used to read
+                them. If it is newer than the data file and was read with the same columns, separator and dtypes, it is
+                loaded instead of parsing the csv; otherwise it is written after parsing. Default is None (no cache).
         '''
         if not self.queries_columns:
             raise ValueError("Queries columns must be set before loading data.")
         if not self.geo_columns:
             raise ValueError("Geographic columns must be set before loading data.")
         
-        print(f'Loading data from {data_path} with columns {self.geo_columns+self.queries_columns} ...')
-        time1 = time.time()
-        self.data = pd.read_csv(data_path, usecols=self.geo_columns+self.queries_columns, sep=sep)
-        time2 = time.time()
-        print(f'Data loaded in {time2 - time1} seconds.')
-        print(f'Data loaded with {self.data.shape[0]} rows and {self.data.shape[1]} columns.\n')
+        logger.info('Loading data from %s with columns %s ...', data_path, self.geo_columns+self.queries_columns)
+        time1 = time.perf_counter()
+        columns = self.geo_columns+self.queries_columns
+        read_parameters = {'columns': columns, 'sep': sep, 'dtype': dtype}
+        counts = None
+        if cache_path is not None and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(data_path):
+            cache = pd.read_pickle(cache_path)
+            if isinstance(cache, dict) and cache.get('read_parameters') == read_parameters:
+                counts = cache['counts']
+                logger.info('Using the aggregated counts cached in %s', cache_path)
+        if counts is None:
+            reader = pd.read_csv(data_path, usecols=columns, sep=sep, dtype=dtype, engine='c', low_memory=False, chunksize=chunksize)
+            if chunksize is None:
+                reader = [reader]
+            # Count the distinct records of each chunk and merge the partial counts.
+            # NOTE: Grouping sorts by the columns, geography first, so the rows of each geographic entity are contiguous.
+            counts = pd.concat([chunk.value_counts(columns, sort=False, dropna=False) for chunk in reader])
+            counts = counts.groupby(level=list(range(len(columns))), dropna=False).sum()
+            if cache_path is not None:
+                pd.to_pickle({'read_parameters': read_parameters, 'counts': counts}, cache_path)
+        self.data = counts.index.to_frame(index=False)
+        self.data_counts = counts.to_numpy()
+        # Encode the columns as categories once, so filtering and grouping work over integer codes
+        for col in columns:
+            self.data[col] = self.data[col].astype('category')
+        # The categories are the sorted unique values of each column
+        self.unique_values = {col: self.data[col].cat.categories.to_numpy() for col in columns}
+        time2 = time.perf_counter()
+        logger.info('Data loaded in %s seconds.', time2 - time1)
+        logger.info('Data loaded with %s rows aggregated into %s distinct records of %s columns.\n', self.data_counts.sum(), self.data.shape[0], self.data.shape[1])
 
     def read_processed_data(self, data_path: str, sep=',') -> None:
         '''Reads the processed data from a file.
@@ -529,12 +762,14 @@ class TopDown:
         if not self.geo_columns:
             raise ValueError("Geographic columns must be set before loading data.")
         
-        print(f'Reading processed data from {data_path} ...')
-        time1 = time.time()
+        logger.info('Reading processed data from %s ...', data_path)
+        time1 = time.perf_counter()
         self.processed_data = pd.read_csv(data_path, sep=sep)
-        time2 = time.time()
-        print(f'Processed data loaded in {time2 - time1} seconds.')
-        print(f'Processed data loaded with {self.data.shape[0]} rows and {self.data.shape[1]} columns.\n')
+        # Sort by geography so the rows of each geographic entity are contiguous
+        self.processed_data.sort_values([col for col in self.geo_columns if col in self.processed_data.columns], kind='stable', ignore_index=True, inplace=True)
+        time2 = time.perf_counter()
+        logger.info('Processed data loaded in %s seconds.', time2 - time1)
+        logger.info('Processed data loaded with %s rows and %s columns.\n', self.data.shape[0], self.data.shape[1])
     
     def set_output_path(self, output_path: str) -> None:
         '''Sets the output path for the TopDown algorithm.
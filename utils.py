@@ -1,34 +1,43 @@
 import numpy as np
 
+# NOTE: All the distances are computed over the last axis, so they can be applied to a single pair of vectors
+# or to two 2-D arrays with one vector per row (e.g. all the nodes of a level of the tree) in a single call.
+
 def manhattan_distance(vector1, vector2):
     '''Computes the Manhattan distance between two vectors.'''
     if vector1 is not None and vector2 is not None:
-        return np.sum(np.abs(vector1 - vector2))
+        # Take the absolute value in the buffer of the difference to avoid a second temporary
+        difference = np.subtract(vector1, vector2)
+        return np.sum(np.abs(difference, out=difference), axis=-1)
     return None
 
 def euclidean_distance(vector1, vector2):
     '''Computes the Euclidean distance between two vectors.'''
     if vector1 is not None and vector2 is not None:
-        return np.sqrt(np.sum((vector1 - vector2) ** 2))
+        # Square in floating point to avoid overflowing the int32 contingency vectors
+        difference = np.subtract(vector1, vector2, dtype=np.float64)
+        return np.sqrt(np.sum(difference ** 2, axis=-1))
     return None
 
 def tvd(vector1, vector2):
     '''Computes the Total Variation Distance (TVD) between two vectors.'''
     if vector1 is not None and vector2 is not None:
-        sum1 = np.sum(vector1)
-        sum2 = np.sum(vector2)
-        if sum1 == 0 or sum2 == 0: return 0
-        p = vector1 / sum1
-        q = vector2 / sum2
-        return 0.5 * np.sum(np.abs(p - q))
+        sum1 = np.sum(vector1, axis=-1, keepdims=True)
+        sum2 = np.sum(vector2, axis=-1, keepdims=True)
+        # Vectors with a zero sum have a distance of 0
+        valid = (sum1 != 0) & (sum2 != 0)
+        p = np.divide(vector1, sum1, out=np.zeros(np.shape(vector1)), where=valid)
+        q = np.divide(vector2, sum2, out=np.zeros(np.shape(vector2)), where=valid)
+        # Reuse the buffer of p to avoid allocating temporaries for the difference and its absolute value
+        np.subtract(p, q, out=p)
+        return 0.5 * np.sum(np.abs(p, out=p), axis=-1)
     return None
 
 def cosine_similarity(vector1, vector2):
     '''Computes the Cosine Similarity between two vectors.'''
     if vector1 is not None and vector2 is not None:
-        dot_product = np.dot(vector1, vector2)
-        norm_a = np.linalg.norm(vector1)
-        norm_b = np.linalg.norm(vector2)
-        if norm_a == 0 or norm_b == 0: return 0
-        return dot_product / (norm_a * norm_b)
-    return None
\ No newline at end of file
+        dot_product = np.sum(vector1 * vector2, axis=-1)
+        norms = np.linalg.norm(vector1, axis=-1) * np.linalg.norm(vector2, axis=-1)
+        # Vectors with a zero norm have a similarity of 0
+        return np.divide(dot_product, norms, out=np.zeros(np.shape(norms)), where=norms != 0)
+    return None